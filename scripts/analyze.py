@@ -0,0 +1,249 @@
+import contextlib
+import sys
+import time
+
+import click
+from pysat.formula import CNF
+from pysat.solvers import Solver
+
+from common import *
+from minimize import process_backdoor as minimize_backdoor, new_solver_limited
+from probing import process_backdoor as probe_backdoor
+
+print = click.echo
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"], max_content_width=999, show_default=True)
+
+
+@click.group(context_settings=CONTEXT_SETTINGS)
+@click.option("--cnf", "path_cnf", type=click.Path(exists=True), help="File with CNF (required)")
+@click.option("--backdoors", "path_backdoors", type=click.Path(exists=True), help="File with backdoors (required)")
+@click.option("--limit", "limit_backdoors", type=int, help="Number of backdoors to use (prefix size)")
+@click.option("--add-units", "is_add_derived_units", is_flag=True, help="Add derived units to the solver")
+@click.option(
+    "--num-confl",
+    type=int,
+    default=0,
+    show_default=True,
+    help="Number of conflicts in 'solve_limited' (0 for using 'propagate')",
+)
+@click.option("--cache-dir", type=click.Path(file_okay=False), help="Directory for caching partitions and semi-easy tasks")
+@click.option("-q", "--quiet", "is_quiet", is_flag=True, help="Do not report each processed backdoor")
+@click.pass_context
+def cli(
+    ctx,
+    path_cnf,
+    path_backdoors,
+    limit_backdoors,
+    is_add_derived_units,
+    num_confl,
+    cache_dir,
+    is_quiet,
+):
+    """
+    Analyze backdoors: minimize their characteristic functions and/or perform failed literal probing,
+    sharing the loaded CNF, the solvers, and the partition of tasks between both analyses.
+
+    Note: the subcommands are reduced versions of 'minimize.py' and 'probing.py'.
+    Backdoors are processed sequentially in a single process, and there are no '--jobs',
+    '--no-duplicates', '--stats-json', '--verbose', or '--warm-start' options.
+    Use the standalone scripts for these.
+    """
+
+    # Note: the inputs are loaded by the subcommand (see 'analyze'), so that its '--help' works without them
+    ctx.obj = dict(
+        path_cnf=path_cnf,
+        path_backdoors=path_backdoors,
+        limit_backdoors=limit_backdoors,
+        is_add_derived_units=is_add_derived_units,
+        num_confl=num_confl,
+        cache_dir=cache_dir,
+        is_quiet=is_quiet,
+    )
+
+
+@cli.command()
+@click.option("-o", "--output", "path_output", type=click.Path(), help="Output file with derived clauses")
+@click.pass_obj
+def minimize(obj, path_output):
+    """
+    Minimize characteristic functions of backdoors, see 'minimize.py'.
+    """
+
+    analyze(obj, is_minimize=True, is_probe=False, path_output_minimize=path_output)
+
+
+@cli.command()
+@click.option("-o", "--output", "path_output", type=click.Path(), help="Output file with derived units")
+@click.pass_obj
+def probe(obj, path_output):
+    """
+    Perform failed literal probing on backdoor variables, see 'probing.py'.
+    """
+
+    analyze(obj, is_minimize=False, is_probe=True, path_output_probe=path_output)
+
+
+@cli.command()
+@click.option("--output-minimize", "path_output_minimize", type=click.Path(), help="Output file with derived clauses")
+@click.option("--output-probe", "path_output_probe", type=click.Path(), help="Output file with derived units (via probing)")
+@click.pass_obj
+def both(obj, path_output_minimize, path_output_probe):
+    """
+    Run both analyses in a single pass over backdoors.
+    """
+
+    analyze(
+        obj,
+        is_minimize=True,
+        is_probe=True,
+        path_output_minimize=path_output_minimize,
+        path_output_probe=path_output_probe,
+    )
+
+
+def analyze(obj, is_minimize, is_probe, path_output_minimize=None, path_output_probe=None):
+    time_start = time.time()
+
+    path_cnf = obj["path_cnf"]
+    path_backdoors = obj["path_backdoors"]
+    limit_backdoors = obj["limit_backdoors"]
+    is_add_derived_units = obj["is_add_derived_units"]
+    num_confl = obj["num_confl"]
+    cache_dir = obj["cache_dir"]
+    is_quiet = obj["is_quiet"]
+
+    for value, name in [(path_cnf, "--cnf"), (path_backdoors, "--backdoors")]:
+        if value is None:
+            raise click.UsageError(f"Missing option '{name}'.", ctx=click.get_current_context().find_root())
+
+    log = make_log(is_quiet)
+
+    print(f"Loading CNF from '{path_cnf}'...")
+    cnf = CNF(from_file=path_cnf)
+    print(f"CNF clauses: {len(cnf.clauses)}")
+    print(f"CNF variables: {cnf.nv}")
+
+    print()
+    print(f"Loading backdoors from '{path_backdoors}'...")
+    backdoors = parse_backdoors(path_backdoors, one_based=True)
+    print(f"Total backdoors: {len(backdoors)}")
+    if backdoors:
+        print(f"First backdoor size: {len(backdoors[0])}")
+
+    if limit_backdoors is not None:
+        print(f"Limiting to {limit_backdoors} backdoors")
+        backdoors = backdoors[:limit_backdoors]
+
+    cache = None
+    if cache_dir:
+        cache = DiskCache(cache_dir, file_fingerprint(path_cnf))
+        print(f"Note: caching results in '{cache.root}'")
+
+    print()
+    is_using_solve_limited = num_confl > 0
+    if is_using_solve_limited:
+        print(f"Note: using 'propagate' and 'solve_limited({num_confl=})'")
+    else:
+        print(f"Note: using 'propagate' only")
+
+    rho_per_backdoor = []
+    unique_units = set()  # all derived units, via both analyses
+    unique_units_neg = set()  # negations of 'unique_units', for detecting conflicting units
+    unique_clauses = [set(), set(), set(), set()]  # derived units, binary, ternary, and large clauses
+    unique_probed_units = set()
+
+    with contextlib.ExitStack() as stack:
+        solver = stack.enter_context(Solver("glucose42", bootstrap_with=cnf))
+        solver_limited = None
+        if is_using_solve_limited:
+            solver_limited = stack.enter_context(new_solver_limited(cnf))
+
+        for i, variables in enumerate(backdoors):
+            k = len(variables)
+            num_tasks = 1 << k
+            log()
+            log(f"=== [{i+1}/{len(backdoors)}] " + "-" * 42)
+            log(f"Backdoor with {k} variables: {variables}")
+
+            # Note: derived units added to the solver change its state
+            state = derived_units_state(unique_units, is_add_derived_units)
+
+            # Note: both analyses share the partition of tasks via 'partition_tasks_cached'
+            units = set()
+            if is_minimize:
+                result = minimize_backdoor(
+                    solver, solver_limited, variables, num_confl, cache, state, log=None if is_quiet else log
+                )
+                num_easy = popcount(result["easy"] | (result["semieasy"] or 0))
+                rho = num_easy / num_tasks
+                log(f"rho = {num_easy}/{num_tasks} = {rho}")
+                rho_per_backdoor.append(rho)
+                if num_easy == num_tasks:
+                    # Note: reported even in quiet mode, since the derived empty clause is not output, see 'backdoor_to_clauses_via_easy'
+                    print(f"Note: all tasks are easy, backdoor #{i+1} refutes the CNF")
+
+                groups = group_clauses_by_size(result["clauses"], is_pack=True)
+                news = [set(group) - unique for group, unique in zip(groups, unique_clauses)]
+                for group, unique in zip(groups, unique_clauses):
+                    unique.update(group)
+                log(
+                    f"Derived {len(groups[0])} ({len(news[0])} new) units, {len(groups[1])} ({len(news[1])} new) binary, {len(groups[2])} ({len(news[2])} new) ternary, and {len(groups[3])} ({len(news[3])} new) large clauses"
+                )
+                units.update(groups[0])
+
+            if is_probe:
+                result = probe_backdoor(solver, solver_limited, variables, num_confl, cache, state)
+                if not is_minimize:
+                    rho = popcount(result["easy"]) / num_tasks
+                    log(f"rho = {popcount(result['easy'])}/{num_tasks} = {rho}")
+                    rho_per_backdoor.append(rho)
+
+                new_probed_units = set(result["units"]) - unique_probed_units
+                unique_probed_units.update(result["units"])
+                log(f"Derived {len(result['units'])} ({len(new_probed_units)} new) units via probing")
+                units.update(result["units"])
+
+            check_conflicting_units(units, unique_units_neg)
+            new_units = units - unique_units
+            unique_units.update(units)
+            unique_units_neg.update(-x for x in units)
+
+            if is_add_derived_units:
+                add_units(solver, solver_limited, sorted(new_units, key=abs))
+
+            sys.stdout.flush()
+
+    print()
+    print("=" * 42)
+    print()
+
+    print(f"rho: {rho_per_backdoor}")
+
+    if is_minimize:
+        print(
+            f"Derived {len(unique_clauses[0])} unique units, {len(unique_clauses[1])} binary, {len(unique_clauses[2])} ternary, and {len(unique_clauses[3])} large clauses"
+        )
+        if path_output_minimize:
+            print(f"Writing derived clauses to '{path_output_minimize}'...")
+            lines = [f"{unit} 0\n" for unit in sorted(unique_clauses[0], key=abs)]
+            for size, unique in zip([2, 3, None], unique_clauses[1:]):
+                lines.extend(" ".join(map(str, unpack_clause(c, size) if size else c)) + " 0\n" for c in sorted(unique))
+            with open(path_output_minimize, "w") as f:
+                f.writelines(lines)
+
+    if is_probe:
+        unique_probed_units = sorted(unique_probed_units, key=abs)
+        print(f"Total {len(unique_probed_units)} unique units derived via probing: {unique_probed_units}")
+        if path_output_probe:
+            print(f"Writing derived units to '{path_output_probe}'...")
+            with open(path_output_probe, "w") as f:
+                s = " ".join(map(str, unique_probed_units))
+                f.write(f"{s}\n")
+
+    print()
+    print(f"All done in {time.time() - time_start:.1f} s")
+
+
+if __name__ == "__main__":
+    cli()
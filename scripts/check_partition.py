@@ -0,0 +1,65 @@
+import random
+
+import click
+from pysat.solvers import Solver
+
+from common import *
+
+print = click.echo
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"], max_content_width=999, show_default=True)
+
+
+def random_cnf(rng, num_vars, num_clauses, num_units):
+    clauses = [[x if rng.random() < 0.5 else -x for x in rng.sample(range(1, num_vars + 1), 3)] for _ in range(num_clauses)]
+    clauses += [[x if rng.random() < 0.5 else -x] for x in rng.sample(range(1, num_vars + 1), num_units)]
+    return clauses
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--num-cnfs", type=int, default=300, help="Number of random CNFs")
+@click.option("--num-vars", type=int, default=40, help="Number of variables in each CNF")
+@click.option("--ratio", type=float, default=3.5, help="Clauses-to-variables ratio")
+@click.option("--num-units", type=int, default=3, help="Number of unit clauses in each CNF")
+@click.option("--size", "backdoor_size", type=int, default=8, help="Backdoor size")
+@click.option("--seed", type=int, default=42, help="Random seed")
+def cli(num_cnfs, num_vars, ratio, num_units, backdoor_size, seed):
+    """
+    Check that `partition_tasks_mask` agrees with `partition_tasks` on random 3-CNFs with unit clauses,
+    using backdoors that contain the variables fixed by these units.
+    """
+
+    rng = random.Random(seed)
+    num_mismatches = 0
+
+    for i in range(num_cnfs):
+        clauses = random_cnf(rng, num_vars, int(num_vars * ratio), num_units)
+        units = [c[0] for c in clauses if len(c) == 1]
+        others = rng.sample([x for x in range(1, num_vars + 1) if x not in map(abs, units)], backdoor_size - len(units))
+        variables = others + [abs(x) for x in units]
+        rng.shuffle(variables)
+
+        with Solver("glucose42", bootstrap_with=clauses[: len(clauses) - len(units)]) as solver:
+            # Note: add the units either upfront or after the first propagation (as with '--add-units')
+            if i % 2 == 1:
+                solver.propagate([])
+            for x in units:
+                solver.add_clause([x])
+            hard, easy = partition_tasks(solver, variables)
+            hard_mask, easy_mask = partition_tasks_mask(solver, variables)
+
+        expected = (
+            sum(1 << cube_to_index(cube) for cube in hard),
+            sum(1 << cube_to_index(cube) for cube in easy),
+        )
+        if (hard_mask, easy_mask) != expected:
+            num_mismatches += 1
+            print(f"Mismatch on CNF #{i} with units {units}, backdoor {variables}")
+
+    print(f"Checked {num_cnfs} CNFs: {num_mismatches} mismatches")
+    if num_mismatches:
+        raise click.exceptions.Exit(1)
+
+
+if __name__ == "__main__":
+    cli()
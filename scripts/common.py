@@ -1,10 +1,15 @@
 import contextlib
+import functools
 import gzip
+import hashlib
 import mmap
 import os
+import pickle
 import re
+import sys
+import tempfile
 from itertools import product
-from typing import List, Iterable
+from typing import List, Iterable, Tuple
 import tqdm
 
 
@@ -27,13 +32,104 @@ def multiunion(iterables):
     return xs
 
 
+def write_line(line=""):
+    """
+    Writes a line to stdout directly, bypassing the per-call overhead of `click.echo`.
+
+    Intended for per-backdoor reports; the caller should flush `sys.stdout` once per backdoor.
+    """
+    sys.stdout.write(line + "\n")
+
+
+def make_log(is_quiet=False):
+    """
+    Returns the function for per-backdoor reports: `write_line`, or a no-op in quiet mode.
+    """
+    if is_quiet:
+        return lambda *args, **kwargs: None
+    return write_line
+
+
 def sorted_clauses(clauses):
     result = [sorted(clause, key=abs) for clause in clauses]
     result.sort(key=lambda c: (len(c), tuple(map(abs, c))))
     return result
 
 
-def parse_backdoors(path) -> List[List[int]]:
+def pack_clause(clause) -> int:
+    """
+    Packs a short clause into a single int, using 32 bits per literal.
+
+    Each literal is encoded as `2*var + sign` (as in binary DRAT), and the first
+    literal occupies the highest bits. Thus, packed clauses are cheap to hash, and
+    sorting them is the same as sorting the clauses literal-wise by variable.
+    """
+
+    packed = 0
+    for lit in clause:
+        packed = (packed << 32) | (abs(lit) << 1) | (lit < 0)
+    return packed
+
+
+def unpack_clause(packed, size) -> Tuple[int, ...]:
+    clause = []
+    for _ in range(size):
+        x = packed & 0xFFFFFFFF
+        clause.append(-(x >> 1) if x & 1 else x >> 1)
+        packed >>= 32
+    clause.reverse()
+    return tuple(clause)
+
+
+def group_clauses_by_size(clauses, is_pack=False):
+    """
+    Groups clauses by size in a single pass.
+
+    When `is_pack` is set, binary and ternary clauses are packed into ints (see `pack_clause`).
+
+    ### Returns:
+        `Tuple[List[int], List[Tuple[int, int]], List[Tuple[int, int, int]], List[Tuple[int, ...]]]`:
+        A tuple of unit literals, binary, ternary, and large clauses,
+        where the literals in each clause are sorted by variable.
+    """
+
+    units = []
+    binary = []
+    ternary = []
+    large = []
+
+    for clause in clauses:
+        n = len(clause)
+        if n == 1:
+            units.append(clause[0])
+        elif n == 2:
+            a, b = clause
+            if abs(a) > abs(b):
+                a, b = b, a
+            binary.append(pack_clause((a, b)) if is_pack else (a, b))
+        elif n == 3:
+            # Sorting network for 3 elements:
+            a, b, c = clause
+            if abs(a) > abs(b):
+                a, b = b, a
+            if abs(b) > abs(c):
+                b, c = c, b
+            if abs(a) > abs(b):
+                a, b = b, a
+            ternary.append(pack_clause((a, b, c)) if is_pack else (a, b, c))
+        else:
+            large.append(tuple(sorted(clause, key=abs)))
+
+    return units, binary, ternary, large
+
+
+def parse_backdoors(path, one_based=False) -> List[List[int]]:
+    """
+    Parses backdoors (lists of 0-based variables) from the file.
+    When `one_based` is set, the variables are converted to 1-based (as in CNF).
+    """
+
+    offset = 1 if one_based else 0
     backdoors = []
     with open(path, "r") as f:
         RE = re.compile(r"\[(\d+(?:, \d+)*)\]")
@@ -41,7 +137,7 @@ def parse_backdoors(path) -> List[List[int]]:
             if m := RE.search(line):
                 variables = [int(x) for x in m.group(1).split(", ")]
                 assert all(v >= 0 for v in variables), "Variables must be non-negative"
-                backdoors.append(variables)
+                backdoors.append([v + offset for v in variables])
     return backdoors
 
 
@@ -77,6 +173,120 @@ def partition_tasks(solver, variables):
     return hard, easy
 
 
+def popcount(x) -> int:
+    return bin(x).count("1")
+
+
+def mask_to_indices(mask) -> List[int]:
+    """
+    Returns the indices of set bits in the `mask`, in increasing order.
+    """
+
+    # Note: 'bin' is linear in the size of the mask, unlike repeatedly clearing the lowest bit
+    bits = bin(mask)[:1:-1]
+    return [i for i, b in enumerate(bits) if b == "1"]
+
+
+def cube_to_index(cube) -> int:
+    """
+    Returns the index of the cube (task) in the order of `product([False, True], repeat=k)`,
+    i.e., the `i`-th bit (counting from the most significant) is set iff the `i`-th literal is negative.
+    """
+
+    index = 0
+    for lit in cube:
+        index = (index << 1) | (lit < 0)
+    return index
+
+
+def index_to_cube(variables, index):
+    """
+    Returns the cube (task) with the given index, see `cube_to_index`.
+    """
+
+    n = len(variables)
+    return [signed(variables[i], (index >> (n - 1 - i)) & 1) for i in range(n)]
+
+
+def partition_tasks_mask(solver, variables):
+    """
+    Partition tasks into "hard" and "easy" categories, same as `partition_tasks`,
+    but skipping whole subtrees of "easy" tasks in the assignment tree,
+    and representing the sets of tasks as bitmasks.
+
+    The tasks are enumerated in the same (depth-first) order as in `partition_tasks`.
+    When a task leads to a conflict, the propagated literals tell us which prefix
+    of the assumptions has led to it: all assumptions before the conflict are on the trail,
+    except those fixed at decision level 0, which are determined upfront.
+    Since Unit Propagation is monotone, all tasks extending that prefix are also "easy",
+    so they are not propagated at all. Thus, at most `2^k + k` propagations are performed.
+
+    ### Returns:
+        `Tuple[int, int]`: Bitmasks (over `2^k` tasks) of "hard" and "easy" tasks,
+        where the `i`-th bit corresponds to the task `index_to_cube(variables, i)`.
+    """
+
+    n = len(variables)
+
+    num_tasks = 1 << n
+
+    # Note: 'propagate' does not report literals fixed at decision level 0 (e.g., CNF units
+    #       or added derived units): an assumption already satisfied there is skipped, and
+    #       an assumption already falsified there leads to a conflict right away.
+    #       For an unassigned variable, the trail contains at least the assumption itself,
+    #       so an empty trail means that the variable is fixed at level 0.
+    fixed = set()  # literals satisfied at level 0
+    for x in variables:
+        (result, propagated) = solver.propagate([x])
+        if not propagated:
+            fixed.add(x if result else -x)
+
+    hard = 0
+    easy = 0
+
+    index = 0
+    while index < num_tasks:
+        assumptions = index_to_cube(variables, index)
+        (result, propagated) = solver.propagate(assumptions)
+
+        if result == True:
+            hard |= 1 << index
+            index += 1
+        elif result == False:
+            # Determine the length of the conflicting prefix:
+            trail = set(propagated)
+            depth = 0
+            while depth < n:
+                lit = assumptions[depth]
+                if -lit in fixed or -lit in trail:
+                    # The assumption is falsified (at level 0 or by the previous ones)
+                    depth += 1
+                    break
+                if lit not in fixed and lit not in trail:
+                    # The assumption has not been reached: the previous ones lead to a conflict
+                    break
+                depth += 1
+
+            # All tasks extending the conflicting prefix are "easy":
+            end = ((index >> (n - depth)) + 1) << (n - depth)
+            easy |= ((1 << (end - index)) - 1) << index
+            index = end
+
+    return hard, easy
+
+
+@functools.lru_cache(maxsize=8192)
+def partition_tasks_cached(solver, variables: Tuple[int, ...], state=()):
+    """
+    Memoized `partition_tasks_mask`, keyed on the solver, the (tuple of) variables, and the `state`.
+
+    Since the clauses added to the solver affect the partition, `state` must identify them
+    (e.g., the tuple of added units).
+    """
+
+    return partition_tasks_mask(solver, list(variables))
+
+
 def determine_semieasy_tasks(solver, hard_tasks, num_confl=1000):
     semieasy = []
 
@@ -94,6 +304,68 @@ def determine_semieasy_tasks(solver, hard_tasks, num_confl=1000):
     return semieasy
 
 
+def determine_semieasy_tasks_mask(solver, variables, hard, num_confl=1000) -> int:
+    """
+    Same as `determine_semieasy_tasks`, but for the bitmask of "hard" tasks, see `partition_tasks_mask`.
+
+    ### Returns:
+        `int`: A bitmask of "semi-easy" tasks.
+    """
+
+    semieasy = 0
+
+    for index in mask_to_indices(hard):
+        solver.conf_budget(num_confl)
+        result = solver.solve_limited(index_to_cube(variables, index))
+        if result == False:
+            semieasy |= 1 << index
+        if result == True:
+            raise ValueError("Unexpected SAT")
+
+    return semieasy
+
+
+@functools.lru_cache(maxsize=8192)
+def determine_semieasy_tasks_cached(solver, variables: Tuple[int, ...], hard, num_confl=1000, state=()):
+    """
+    Memoized `determine_semieasy_tasks_mask`, see `partition_tasks_cached`.
+    """
+
+    return determine_semieasy_tasks_mask(solver, list(variables), hard, num_confl)
+
+
+def derived_units_state(units, is_add_units) -> Tuple[int, ...]:
+    """
+    Identifies the clauses added to the solvers on top of the CNF, e.g., for `partition_tasks_cached`:
+    the sorted derived `units` when they are added to the solvers (see `add_units`), otherwise nothing.
+    """
+
+    return tuple(sorted(units, key=abs)) if is_add_units else ()
+
+
+def check_conflicting_units(units, unique_units_neg):
+    """
+    Raises `RuntimeError` when some of the derived `units` conflicts with the previously derived ones,
+    given by their negations `unique_units_neg`.
+    """
+
+    if conflicting := set(units) & unique_units_neg:
+        raise RuntimeError(f"Wow! {next(iter(conflicting))}")
+
+
+def add_units(solver, solver_limited, units):
+    """
+    Adds the (derived) `units` to the `solver` and, if given, to the `solver_limited`.
+
+    Note: 'solve_limited' keeps its learnt clauses between calls, so the units also strengthen it.
+    """
+
+    for unit in units:
+        solver.add_clause([unit])
+        if solver_limited is not None:
+            solver_limited.add_clause([unit])
+
+
 def perform_probing(solver, variables, is_add_units=False) -> List[int]:
     """
     Performs failed literal probing.
@@ -153,10 +425,11 @@ def perform_probing_limited(solver, variables, num_confl=1000) -> List[int]:
     return sorted(units, key=abs)
 
 
-def cubes_to_dnf(variables, cubes):
+def cubes_to_dnf(variables, cubes, log=print):
     from pyeda.inter import exprvar, And, Or
 
-    print(f"Converting {len(cubes)} cubes over {len(variables)} variables into DNF...")
+    if log:
+        log(f"Converting {len(cubes)} cubes over {len(variables)} variables into DNF...")
 
     for cube in cubes:
         assert variables == [abs(lit) for lit in cube], f"cube={cube}, vars={variables}"
@@ -181,16 +454,18 @@ def cubes_to_dnf(variables, cubes):
     return dnf
 
 
-def minimize_dnf(dnf):
+def minimize_dnf(dnf, log=print):
     from pyeda.inter import espresso_exprs
 
-    print(f"Minimizing DNF via Espresso...")
+    if log:
+        log(f"Minimizing DNF via Espresso...")
     min_dnf = espresso_exprs(dnf)
     return min_dnf
 
 
-def cnf_to_clauses(cnf):
-    print("Converting CNF into clauses...")
+def cnf_to_clauses(cnf, log=print):
+    if log:
+        log("Converting CNF into clauses...")
 
     assert cnf.is_cnf()
 
@@ -207,22 +482,171 @@ def cnf_to_clauses(cnf):
 
     clauses = result
     clauses.sort(key=lambda x: (len(x), tuple(map(abs, x))))
-    print(
-        f"Total {len(clauses)} clauses: {sum(1 for clause in clauses if len(clause) == 1)} units, {sum(1 for clause in clauses if len(clause) == 2)} binary, {sum(1 for clause in clauses if len(clause) == 3)} ternary, {sum(1 for clause in clauses if len(clause) > 3)} larger"
-    )
+    if log:
+        log(
+            f"Total {len(clauses)} clauses: {sum(1 for clause in clauses if len(clause) == 1)} units, {sum(1 for clause in clauses if len(clause) == 2)} binary, {sum(1 for clause in clauses if len(clause) == 3)} ternary, {sum(1 for clause in clauses if len(clause) > 3)} larger"
+        )
     return clauses
 
 
-def backdoor_to_clauses_via_easy(variables, easy):
+def prime_implicants(k, on):
+    """
+    Computes all prime implicants of the Boolean function of `k` variables
+    given by the bitmask `on` of its minterms (the truth table),
+    bit-parallel over all `2^k` assignments at once.
+
+    Each implicant is represented by a pair `(value, care)` of bitmasks:
+    the implicant covers all assignments `m` such that `m & care == value`.
+
+    ### Returns:
+        `List[Tuple[int, int]]`: A list of prime implicants.
+    """
+
+    n = 1 << k
+    full = (1 << k) - 1
+
+    # zeros[j] is the bitmask of assignments with j-th bit unset:
+    ones = (1 << n) - 1
+    zeros = [ones // ((1 << (2 << j)) - 1) * ((1 << (1 << j)) - 1) for j in range(k)]
+
+    # valid[free] is the bitmask of assignments `m` with `m & free == 0` such that
+    # the implicant `(m, full & ~free)` is fully contained in `on`:
+    valid = [0] * n
+    valid[0] = on
+    for free in range(1, n):
+        bit = free & -free
+        j = bit.bit_length() - 1
+        prev = valid[free ^ bit]
+        valid[free] = prev & (prev >> bit) & zeros[j]
+
+    primes = []
+    for free in range(n):
+        if not valid[free]:
+            continue
+        # Note: the implicant is not prime when it is absorbed by the one with one more free variable
+        absorbed = 0
+        for j in range(k):
+            bit = 1 << j
+            if not free & bit:
+                larger = valid[free | bit]
+                absorbed |= larger | (larger << bit)
+        care = full & ~free
+        primes.extend((m, care) for m in mask_to_indices(valid[free] & ~absorbed))
+
+    return primes
+
+
+def implicant_cover(k, value, care) -> int:
+    """
+    Returns the bitmask (over `2^k` assignments) of assignments covered by the implicant.
+    """
+
+    cover = 1
+    free = ((1 << k) - 1) & ~care
+    while free:
+        bit = free & -free
+        free ^= bit
+        cover |= cover << bit
+    return cover << value
+
+
+def minimize_via_qm(k, on):
+    """
+    Minimizes the DNF of the Boolean function of `k` variables given by the bitmask `on` of its minterms:
+    computes prime implicants (see `prime_implicants`), and then selects the cover
+    by taking all essential prime implicants and greedily adding the largest ones.
+
+    Note: the greedy cover is not always minimal, so it may contain a few more implicants than
+    the one found by Espresso (e.g., 87 vs 85 for the easy tasks of 8-variable backdoors).
+
+    ### Returns:
+        `List[Tuple[int, int]]`: A list of `(value, care)` implicants, see `prime_implicants`.
+    """
+
+    primes = prime_implicants(k, on)
+    covers = [implicant_cover(k, value, care) for value, care in primes]
+
+    uncovered = on
+
+    # Essential prime implicants, which are the only ones covering some minterm:
+    once = 0  # minterms covered at least once
+    twice = 0  # minterms covered at least twice
+    for cover in covers:
+        twice |= once & cover
+        once |= cover
+    essential = once & ~twice
+    chosen = {i for i, cover in enumerate(covers) if cover & essential}
+    for i in chosen:
+        uncovered &= ~covers[i]
+
+    # Greedy set cover for the rest:
+    while uncovered:
+        i = max(range(len(primes)), key=lambda i: popcount(covers[i] & uncovered))
+        chosen.add(i)
+        uncovered &= ~covers[i]
+
+    return [primes[i] for i in sorted(chosen)]
+
+
+def backdoor_to_clauses_via_easy(variables, easy, log=print):
+    """
+    Derives the clauses (minimized CNF) of the characteristic function of the backdoor
+    from its "easy" tasks, given as a bitmask (see `partition_tasks_mask`).
+
+    Progress messages are reported via `log` (pass `None` to skip them).
+
+    Note: when all tasks are easy, the backdoor refutes the CNF, and the characteristic function
+    is the empty clause. It is not returned, so the caller should check for this case.
+    When no tasks are easy, there are no clauses.
+    """
+
+    if easy == 0 or easy == (1 << (1 << len(variables))) - 1:
+        return []
+
+    if len(variables) <= QM_MAX_VARIABLES:
+        return backdoor_to_clauses_via_easy_qm(variables, easy, log)
+
+    easy = [index_to_cube(variables, index) for index in mask_to_indices(easy)]
     # Note: here, 'dnf' represents the negation of characteristic function,
     #       because we use "easy" tasks here.
-    dnf = cubes_to_dnf(variables, easy)
-    (min_dnf,) = minimize_dnf(dnf)
+    dnf = cubes_to_dnf(variables, easy, log)
+    (min_dnf,) = minimize_dnf(dnf, log)
     min_cnf = (~min_dnf).to_cnf()  # here, we negate the function back
-    clauses = cnf_to_clauses(min_cnf)
+    clauses = cnf_to_clauses(min_cnf, log)
     return clauses
 
 
+# Maximum backdoor size for which the characteristic function is minimized via
+# Quine-McCluskey procedure instead of Espresso (which scales better).
+# Note: bit-parallel prime implicants take O(4^k) bits of memory, see `prime_implicants`.
+QM_MAX_VARIABLES = 12
+
+
+def backdoor_to_clauses_via_easy_qm(variables, easy, log=print):
+    """
+    Same as `backdoor_to_clauses_via_easy`, but minimizes via Quine-McCluskey procedure.
+    """
+
+    k = len(variables)
+
+    if log:
+        log(f"Minimizing {popcount(easy)} cubes over {k} variables via Quine-McCluskey...")
+
+    # Note: the implicants of "easy" tasks are the negations of the resulting clauses
+    implicants = minimize_via_qm(k, easy)
+    clauses = []
+    for value, care in implicants:
+        clause = []
+        for i in range(k):
+            bit = 1 << (k - 1 - i)
+            if care & bit:
+                # Note: negated literal from the implicant
+                clause.append(variables[i] if value & bit else -variables[i])
+        clauses.append(clause)
+
+    return sorted_clauses(clauses)
+
+
 def backdoor_to_clauses_via_hard(variables, hard):
     dnf = cubes_to_dnf(variables, hard)
     (min_dnf,) = minimize_dnf(dnf)
@@ -357,6 +781,64 @@ def parse_binary_drat_mmap_tqdm(path: str):
                 yield DratParserContext(t)
 
 
+def file_fingerprint(path) -> str:
+    """
+    Computes a short SHA-256 fingerprint of the file contents.
+    """
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+class DiskCache:
+    """
+    Persistent on-disk cache of pickled values, one file per key,
+    stored under `<cache_dir>/<fingerprint>/<kind>/`.
+
+    Keys are hashed via SHA-256 of their `repr`, which (unlike `hash`)
+    is stable across runs.
+
+    ### Usage:
+    ```
+    cache = DiskCache(cache_dir, file_fingerprint(path_cnf))
+    value = cache.get("partition", key)
+    if value is None:
+        value = compute()
+        cache.put("partition", key, value)
+    ```
+    """
+
+    def __init__(self, cache_dir, fingerprint):
+        self.root = os.path.join(cache_dir, fingerprint)
+
+    def _path(self, kind, key):
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()
+        return os.path.join(self.root, kind, f"{digest}.pkl")
+
+    def get(self, kind, key, default=None):
+        try:
+            with open(self._path(kind, key), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return default
+
+    def put(self, kind, key, value):
+        path = self._path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first, then atomically replace:
+        fd, path_tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f)
+            os.replace(path_tmp, path)
+        except BaseException:
+            os.remove(path_tmp)
+            raise
+
+
 def get_file_size(file):
     stat = os.stat(file.fileno())
     return stat.st_size
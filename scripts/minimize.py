@@ -1,3 +1,7 @@
+import contextlib
+import json
+import multiprocessing
+import sys
 import time
 
 import click
@@ -10,6 +14,101 @@ print = click.echo
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"], max_content_width=999, show_default=True)
 
+# Per-worker state, initialized once in each worker process by `_init_worker`:
+_solver = None
+_solver_limited = None
+_num_confl = 0
+_cache = None
+_state_limited = ()
+
+
+def _init_worker(path_cnf, num_confl, cache, path_warm_start, state_limited):
+    global _solver, _solver_limited, _num_confl, _cache, _state_limited
+    cnf = CNF(from_file=path_cnf)
+    _solver = Solver("glucose42", bootstrap_with=cnf)
+    if num_confl > 0:
+        _solver_limited = new_solver_limited(cnf, path_warm_start)
+    _num_confl = num_confl
+    _cache = cache
+    _state_limited = state_limited
+
+
+def _work(variables):
+    # Note: workers do not report progress messages, which would interleave with the ordered reports
+    return process_backdoor(_solver, _solver_limited, variables, _num_confl, _cache, state_limited=_state_limited)
+
+
+def read_warm_start(path):
+    """
+    Reads the clauses for warm-starting the 'solve_limited' solver, see `new_solver_limited`.
+
+    Note: an empty clause (e.g., from a bare " 0" line) would make every 'solve_limited' call UNSAT,
+    i.e., all hard tasks would be counted as semi-easy, so it is rejected.
+    """
+
+    clauses = CNF(from_file=path).clauses
+    if any(len(clause) == 0 for clause in clauses):
+        raise ValueError(f"Empty clause in the warm-start file '{path}'")
+    return clauses
+
+
+def new_solver_limited(cnf, path_warm_start=None):
+    """
+    Creates the solver for 'solve_limited' calls, warm-started with the clauses
+    from `path_warm_start` (e.g., the output of a previous run), if given.
+
+    Note: the learnt clauses of CaDiCaL cannot be exported via PySAT, but the derived
+    clauses are implied by the CNF as well, so they can serve the same purpose.
+    """
+
+    solver = Solver("cadical153", bootstrap_with=cnf)
+    if path_warm_start:
+        solver.append_formula(read_warm_start(path_warm_start))
+    return solver
+
+
+def process_backdoor(solver, solver_limited, variables, num_confl, cache=None, state=(), state_limited=(), log=None):
+    """
+    Partition the tasks for the given backdoor, determine semi-easy tasks
+    (when `num_confl > 0`), and minimize the characteristic function.
+
+    When `cache` (a `DiskCache`) is given, the partition and semi-easy tasks
+    are looked up there first. The `state` must identify the clauses added
+    to the solvers on top of the CNF (e.g., the sorted derived units),
+    and `state_limited` -- the clauses added only to the `solver_limited`.
+    Progress messages of the minimization are reported via `log`, if given.
+
+    ### Returns:
+        `dict` with bitmasks of "hard" and "easy" tasks, "semieasy" tasks
+        (`None` when using 'propagate' only), "time_semieasy", and derived
+        "clauses" (via both easy and semi-easy tasks).
+    """
+
+    key = (tuple(variables), state)
+
+    partition = cache.get("partition_mask", key) if cache else None
+    if partition is None:
+        partition = partition_tasks_cached(solver, tuple(variables), state)
+        if cache:
+            cache.put("partition_mask", key, partition)
+    hard, easy = partition
+
+    semieasy = None
+    time_semieasy = 0.0
+    if num_confl > 0:
+        time_start_semieasy = time.time()
+        key_limited = (key, num_confl, state_limited)
+        semieasy = cache.get("semieasy_mask", key_limited) if cache else None
+        if semieasy is None:
+            semieasy = determine_semieasy_tasks_cached(solver_limited, tuple(variables), hard, num_confl, state)
+            if cache:
+                cache.put("semieasy_mask", key_limited, semieasy)
+        time_semieasy = time.time() - time_start_semieasy
+
+    clauses = backdoor_to_clauses_via_easy(variables, easy | (semieasy or 0), log)
+
+    return dict(hard=hard, easy=easy, semieasy=semieasy, time_semieasy=time_semieasy, clauses=clauses)
+
 
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.option("--cnf", "path_cnf", required=True, type=click.Path(exists=True), help="File with CNF")
@@ -27,6 +126,17 @@ CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"], max_content_width=99
 @click.option(
     "--allow-duplicates/--no-duplicates", "is_allow_duplicates", default=True, help="Dump clauses which already present in CNF"
 )
+@click.option("-q", "--quiet", "is_quiet", is_flag=True, help="Do not report each processed backdoor")
+@click.option("-v", "--verbose", "is_verbose", is_flag=True, help="Report per-backdoor statistics at the end")
+@click.option("--stats-json", "path_stats_json", type=click.Path(), help="Output JSON file with per-backdoor statistics")
+@click.option("-j", "--jobs", type=int, default=1, help="Number of worker processes (1 for sequential processing)")
+@click.option("--cache-dir", type=click.Path(file_okay=False), help="Directory for caching partitions and semi-easy tasks")
+@click.option(
+    "--warm-start",
+    "path_warm_start",
+    type=click.Path(exists=True),
+    help="File with clauses (e.g., output of a previous run) to add to the 'solve_limited' solver",
+)
 def cli(
     path_cnf,
     path_backdoors,
@@ -35,36 +145,37 @@ def cli(
     is_add_derived_units,
     num_confl,
     is_allow_duplicates,
+    is_quiet,
+    is_verbose,
+    path_stats_json,
+    jobs,
+    cache_dir,
+    path_warm_start,
 ):
     time_start = time.time()
 
+    log = make_log(is_quiet)
+
     print(f"Loading CNF from '{path_cnf}'...")
     cnf = CNF(from_file=path_cnf)
     print(f"CNF clauses: {len(cnf.clauses)}")
     print(f"CNF variables: {cnf.nv}")
 
     print(f"Grouping CNF clauses by size...")
-    cnf_units = []
-    cnf_binary = []
-    cnf_ternary = []
-    cnf_large = []
-    for clause in cnf.clauses:
-        if len(clause) == 1:
-            cnf_units.append(clause[0])
-        elif len(clause) == 2:
-            cnf_binary.append(tuple(sorted(clause, key=abs)))
-        elif len(clause) == 3:
-            cnf_ternary.append(tuple(sorted(clause, key=abs)))
-        else:
-            cnf_large.append(tuple(sorted(clause, key=abs)))
+    cnf_units, cnf_binary, cnf_ternary, cnf_large = group_clauses_by_size(cnf.clauses, is_pack=True)
     print(f"CNF unit clauses: {len(cnf_units)}")
     print(f"CNF binary clauses: {len(cnf_binary)}")
     print(f"CNF ternary clauses: {len(cnf_ternary)}")
     print(f"CNF large clauses: {len(cnf_large)}")
+    # Note: only membership tests are performed on these from now on
+    cnf_units = frozenset(cnf_units)
+    cnf_binary = frozenset(cnf_binary)
+    cnf_ternary = frozenset(cnf_ternary)
+    cnf_large = frozenset(cnf_large)
 
     print()
     print(f"Loading backdoors from '{path_backdoors}'...")
-    backdoors = parse_backdoors(path_backdoors)
+    backdoors = parse_backdoors(path_backdoors, one_based=True)
     print(f"Total backdoors: {len(backdoors)}")
     if backdoors:
         print(f"First backdoor size: {len(backdoors[0])}")
@@ -74,23 +185,43 @@ def cli(
         print(f"Limiting to {limit_backdoors} backdoors")
         backdoors = backdoors[:limit_backdoors]
 
-    unique_variables = sorted(multiunion(backdoors), key=abs)
-    print(f"Total variables in {len(backdoors)} backdoors: {sum(map(len, backdoors))}")
+    # Note: only the number of unique variables is reported, so there is no need to sort them
+    unique_variables = multiunion(backdoors)
+    num_total_variables = sum(map(len, backdoors))
+    print(f"Total variables in {len(backdoors)} backdoors: {num_total_variables}")
     print(f"Unique variables in {len(backdoors)} backdoors: {len(unique_variables)}")
 
     print()
     is_using_solve_limited = num_confl > 0
     if is_using_solve_limited:
         print(f"Note: using 'propagate' and 'solve_limited({num_confl=})'")
-        solver_limited = Solver("cadical153", bootstrap_with=cnf)
     else:
         print(f"Note: using 'propagate' only")
+    if jobs > 1 and is_add_derived_units:
+        print(f"Note: adding derived units requires sequential processing, ignoring '--jobs {jobs}'")
+        jobs = 1
+    if path_warm_start and not is_using_solve_limited:
+        print(f"Note: warm-starting applies only to 'solve_limited', ignoring '--warm-start' without '--num-confl'")
+        path_warm_start = None
+
+    cache = None
+    if cache_dir:
+        cache = DiskCache(cache_dir, file_fingerprint(path_cnf))
+        print(f"Note: caching results in '{cache.root}'")
+
+    state_limited = ()
+    if is_using_solve_limited and path_warm_start:
+        print(f"Note: warm-starting 'solve_limited' solver with clauses from '{path_warm_start}'")
+        # Note: validate the file here, before the worker processes read it
+        print(f"Warm-start clauses: {len(read_warm_start(path_warm_start))}")
+        state_limited = file_fingerprint(path_warm_start)
 
     rho_per_backdoor = []
 
     units_per_backdoor = []
     new_units_per_backdoor = []
     unique_units = set()
+    unique_units_neg = set()  # negations of 'unique_units', for detecting conflicting units
 
     binary_per_backdoor = []
     new_binary_per_backdoor = []
@@ -104,121 +235,139 @@ def cli(
     new_large_per_backdoor = []
     unique_large = set()
 
-    with Solver("glucose42", bootstrap_with=cnf) as solver:
-        for i, variables in enumerate(backdoors):
-            print()
-            print(f"=== [{i+1}/{len(backdoors)}] " + "-" * 42)
-
-            # Convert to 1-based:
-            variables = [v + 1 for v in variables]
-
-            print(f"Backdoor with {len(variables)} variables: {variables}")
-
-            print(f"Partioning tasks...")
-            hard, easy = partition_tasks(solver, variables)
-            assert len(hard) + len(easy) == 2 ** len(variables)
-            print(f"Total 2^{len(variables)} = {2**len(variables)} tasks: {len(hard)} hard and {len(easy)} easy")
-
-            if is_using_solve_limited:
-                print(f"Determining semi-easy tasks using 'solve_limited({num_confl=})'...")
-                time_start_semieasy = time.time()
-                semieasy = determine_semieasy_tasks(solver_limited, hard, num_confl)
-                print(f"... done in {time.time() - time_start_semieasy:.3f} s")
-                print(f"Semi-easy tasks: {len(semieasy)}")
-                easy += semieasy
-
-            rho = len(easy) / 2 ** len(variables)
-            print(f"rho = {len(easy)}/{2**len(variables)} = {rho}")
-            rho_per_backdoor.append(rho)
-
-            # print()
-            print(f"Minimizing characteristic function...")
-            clauses = backdoor_to_clauses_via_easy(variables, easy)
-
-            units = sorted((c[0] for c in clauses if len(c) == 1), key=abs)
-            units_per_backdoor.append(units)
-            for unit in units:
-                if -unit in unique_units:
-                    raise RuntimeError(f"Wow! {unit}")
-            new_units = [x for x in units if x not in unique_units]
-            new_units_per_backdoor.append(new_units)
-            unique_units.update(units)
-            print(f"Derived {len(units)} ({len(new_units)} new, {sum(1 for x in units if x in cnf_units)} in cnf) units: {units}")
-
-            binary = sorted(tuple(sorted(c, key=abs)) for c in clauses if len(c) == 2)
-            binary_per_backdoor.append(binary)
-            new_binary = [x for x in binary if x not in unique_binary]
-            new_binary_per_backdoor.append(new_binary)
-            unique_binary.update(binary)
-            print(
-                f"Derived {len(binary)} ({len(new_binary)} new, {sum(1 for c in binary if c in cnf_binary)} in cnf) binary clauses: {binary}"
-            )
-
-            ternary = sorted(tuple(sorted(c, key=abs)) for c in clauses if len(c) == 3)
-            ternary_per_backdoor.append(ternary)
-            new_ternary = [x for x in ternary if x not in unique_ternary]
-            new_ternary_per_backdoor.append(new_ternary)
-            unique_ternary.update(ternary)
-            print(
-                f"Derived {len(ternary)} ({len(new_ternary)} new, {sum(1 for c in ternary if c in cnf_ternary)} in cnf) ternary clauses: {ternary}"
+    # Note: buckets in the order of 'group_clauses_by_size', as tuples of
+    #       (name, size for 'unpack_clause', sort key, per-backdoor, new per-backdoor, unique, in CNF)
+    buckets = [
+        ("units", None, abs, units_per_backdoor, new_units_per_backdoor, unique_units, cnf_units),
+        ("binary clauses", 2, None, binary_per_backdoor, new_binary_per_backdoor, unique_binary, cnf_binary),
+        ("ternary clauses", 3, None, ternary_per_backdoor, new_ternary_per_backdoor, unique_ternary, cnf_ternary),
+        ("large clauses", None, None, large_per_backdoor, new_large_per_backdoor, unique_large, cnf_large),
+    ]
+
+    with contextlib.ExitStack() as stack:
+        pool = None
+        if jobs > 1:
+            print(f"Note: processing backdoors using {jobs} worker processes")
+            pool = stack.enter_context(
+                multiprocessing.Pool(
+                    jobs,
+                    initializer=_init_worker,
+                    initargs=(path_cnf, num_confl, cache, path_warm_start, state_limited),
+                ),
             )
+            results = pool.imap(_work, backdoors, chunksize=4)
+        else:
+            solver = stack.enter_context(Solver("glucose42", bootstrap_with=cnf))
+            solver_limited = None
+            if is_using_solve_limited:
+                solver_limited = stack.enter_context(new_solver_limited(cnf, path_warm_start))
 
-            large = sorted(tuple(sorted(c, key=abs)) for c in clauses if len(c) > 3)
-            large_per_backdoor.append(large)
-            new_large = [x for x in large if x not in unique_large]
-            new_large_per_backdoor.append(new_large)
-            unique_large.update(large)
-            print(f"Derived {len(large)} ({len(new_large)} new, {sum(1 for c in large if c in cnf_large)} in cnf) large clauses: {large}")
+        for i, variables in enumerate(backdoors):
+            log()
+            log(f"=== [{i+1}/{len(backdoors)}] " + "-" * 42)
+            k = len(variables)
+            num_tasks = 1 << k
+            log(f"Backdoor with {k} variables: {variables}")
+
+            if pool is not None:
+                result = next(results)
+            else:
+                # Note: derived units added to the solver change its state
+                state = derived_units_state(unique_units, is_add_derived_units)
+                result = process_backdoor(
+                    solver, solver_limited, variables, num_confl, cache, state, state_limited, log=None if is_quiet else log
+                )
+            hard = result["hard"]
+            easy = result["easy"]
+            semieasy = result["semieasy"]
+            clauses = result["clauses"]
+
+            num_hard = popcount(hard)
+            num_easy = popcount(easy)
+            assert num_hard + num_easy == num_tasks
+            log(f"Total 2^{k} = {num_tasks} tasks: {num_hard} hard and {num_easy} easy")
+
+            if semieasy is not None:
+                log(f"Determined semi-easy tasks using 'solve_limited({num_confl=})' in {result['time_semieasy']:.3f} s")
+                log(f"Semi-easy tasks: {popcount(semieasy)}")
+                num_easy += popcount(semieasy)
+
+            rho = num_easy / num_tasks
+            log(f"rho = {num_easy}/{num_tasks} = {rho}")
+            rho_per_backdoor.append(rho)
+            if num_easy == num_tasks:
+                # Note: reported even in quiet mode, since the derived empty clause is not output, see 'backdoor_to_clauses_via_easy'
+                print(f"Note: all tasks are easy, backdoor #{i+1} refutes the CNF")
+
+            # Note: binary and ternary clauses are packed into ints, see 'pack_clause'
+            groups = group_clauses_by_size(clauses, is_pack=True)
+            check_conflicting_units(groups[0], unique_units_neg)
+
+            for group, (name, size, key, per_backdoor, new_per_backdoor, unique, in_cnf) in zip(groups, buckets):
+                group.sort(key=key)
+                new = sorted(set(group) - unique, key=key)
+                unique.update(group)
+                per_backdoor.append(group)
+                new_per_backdoor.append(new)
+                if not is_quiet:
+                    shown = [unpack_clause(c, size) for c in group] if size else group
+                    log(f"Derived {len(group)} ({len(new)} new, {sum(1 for c in group if c in in_cnf)} in cnf) {name}: {shown}")
+
+            new_units = new_units_per_backdoor[-1]
+            unique_units_neg.update(-x for x in groups[0])
 
             if is_add_derived_units:
-                for unit in new_units:
-                    solver.add_clause([unit])
+                add_units(solver, solver_limited, new_units)
 
-    if is_using_solve_limited:
-        solver_limited.delete()
-        del solver_limited
+            sys.stdout.flush()
 
     print()
     print("=" * 42)
     print()
 
-    print(f"{rho_per_backdoor = }")
-    print(f"{units_per_backdoor = }")
-    print(f"{new_units_per_backdoor = }")
-    print(f"{binary_per_backdoor = }")
-    print(f"{new_binary_per_backdoor = }")
-    print(f"{ternary_per_backdoor = }")
-    print(f"{new_ternary_per_backdoor = }")
-    print(f"{large_per_backdoor = }")
-    print(f"{new_large_per_backdoor = }")
+    if is_verbose or path_stats_json:
+        stats = dict(
+            rho_per_backdoor=rho_per_backdoor,
+            units_per_backdoor=units_per_backdoor,
+            new_units_per_backdoor=new_units_per_backdoor,
+            binary_per_backdoor=[[unpack_clause(c, 2) for c in cs] for cs in binary_per_backdoor],
+            new_binary_per_backdoor=[[unpack_clause(c, 2) for c in cs] for cs in new_binary_per_backdoor],
+            ternary_per_backdoor=[[unpack_clause(c, 3) for c in cs] for cs in ternary_per_backdoor],
+            new_ternary_per_backdoor=[[unpack_clause(c, 3) for c in cs] for cs in new_ternary_per_backdoor],
+            large_per_backdoor=large_per_backdoor,
+            new_large_per_backdoor=new_large_per_backdoor,
+        )
+
+        if is_verbose:
+            for name, value in stats.items():
+                print(f"{name} = {value}")
+
+        if path_stats_json:
+            print(f"Writing per-backdoor statistics to '{path_stats_json}'...")
+            with open(path_stats_json, "w") as f:
+                json.dump(stats, f)
 
     if path_output:
         print()
         print(f"Writing results to '{path_output}'...")
+        lines = []
+        # Note: when duplicates are not allowed, skip clauses which are already present in CNF
+        lines.extend(f"{unit} 0\n" for unit in unique_units if is_allow_duplicates or unit not in cnf_units)
+        for unique_clauses, cnf_clauses, size in [
+            (unique_binary, cnf_binary, 2),
+            (unique_ternary, cnf_ternary, 3),
+            (unique_large, cnf_large, None),
+        ]:
+            lines.extend(
+                " ".join(map(str, unpack_clause(c, size) if size else c)) + " 0\n"
+                for c in unique_clauses
+                if is_allow_duplicates or c not in cnf_clauses
+            )
         with open(path_output, "w") as f:
-            for unit in unique_units:
-                if not is_allow_duplicates and unit in cnf_units:
-                    # skip duplicate
-                    continue
-                f.write(f"{unit} 0\n")
-            for c in unique_binary:
-                if not is_allow_duplicates and c in cnf_binary:
-                    # skip duplicate
-                    continue
-                f.write(" ".join(map(str, c)) + " 0\n")
-            for c in unique_ternary:
-                if not is_allow_duplicates and c in cnf_ternary:
-                    # skip duplicate
-                    continue
-                f.write(" ".join(map(str, c)) + " 0\n")
-            for c in unique_large:
-                if not is_allow_duplicates and c in cnf_large:
-                    # skip duplicate
-                    continue
-                f.write(" ".join(map(str, c)) + " 0\n")
+            f.writelines(lines)
 
     print()
-    print(f"Total variables in {len(backdoors)} backdoors: {sum(map(len, backdoors))}")
+    print(f"Total variables in {len(backdoors)} backdoors: {num_total_variables}")
     print(f"Unique variables in {len(backdoors)} backdoors: {len(unique_variables)}")
     print(
         f"Total derived (non-unique) {sum(map(len, units_per_backdoor))} units, {sum(map(len, binary_per_backdoor))} binary, {sum(map(len, ternary_per_backdoor))} ternary, and {sum(map(len, large_per_backdoor))} larger clauses"
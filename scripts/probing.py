@@ -1,3 +1,6 @@
+import contextlib
+import multiprocessing
+import sys
 import time
 
 import click
@@ -10,6 +13,58 @@ print = click.echo
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"], max_content_width=999, show_default=True)
 
+# Per-worker state, initialized once in each worker process by `_init_worker`:
+_solver = None
+_solver_limited = None
+_num_confl = 0
+_cache = None
+
+
+def _init_worker(path_cnf, num_confl, cache):
+    global _solver, _solver_limited, _num_confl, _cache
+    cnf = CNF(from_file=path_cnf)
+    _solver = Solver("glucose42", bootstrap_with=cnf)
+    if num_confl > 0:
+        _solver_limited = Solver("cadical153", bootstrap_with=cnf)
+    _num_confl = num_confl
+    _cache = cache
+
+
+def _work(variables):
+    return process_backdoor(_solver, _solver_limited, variables, _num_confl, _cache)
+
+
+def process_backdoor(solver, solver_limited, variables, num_confl, cache=None, state=()):
+    """
+    Partition the tasks for the given backdoor and perform failed literal probing,
+    either using 'propagate' or (when `num_confl > 0`) using 'solve_limited'.
+
+    When `cache` (a `DiskCache`) is given, the partition is looked up there first.
+    The `state` must identify the clauses added to the solver on top of the CNF.
+
+    ### Returns:
+        `dict` with bitmasks of "hard" and "easy" tasks, derived "units", and "time_limited".
+    """
+
+    key = (tuple(variables), state)
+
+    partition = cache.get("partition_mask", key) if cache else None
+    if partition is None:
+        partition = partition_tasks_cached(solver, tuple(variables), state)
+        if cache:
+            cache.put("partition_mask", key, partition)
+    hard, easy = partition
+
+    time_limited = 0.0
+    if num_confl > 0:
+        time_start_limited = time.time()
+        units = perform_probing_limited(solver_limited, variables)
+        time_limited = time.time() - time_start_limited
+    else:
+        units = perform_probing(solver, variables)
+
+    return dict(hard=hard, easy=easy, units=units, time_limited=time_limited)
+
 
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.option("--cnf", "path_cnf", required=True, type=click.Path(exists=True), help="File with CNF")
@@ -24,6 +79,9 @@ CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"], max_content_width=99
     show_default=True,
     help="Number of conflicts in 'solve_limited' (0 for using 'propagate')",
 )
+@click.option("-q", "--quiet", "is_quiet", is_flag=True, help="Do not report each processed backdoor")
+@click.option("-j", "--jobs", type=int, default=1, help="Number of worker processes (1 for sequential processing)")
+@click.option("--cache-dir", type=click.Path(file_okay=False), help="Directory for caching partitions")
 def cli(
     path_cnf,
     path_backdoors,
@@ -31,9 +89,14 @@ def cli(
     limit_backdoors,
     is_add_derived_units,
     num_confl,
+    is_quiet,
+    jobs,
+    cache_dir,
 ):
     time_start = time.time()
 
+    log = make_log(is_quiet)
+
     print(f"Loading CNF from '{path_cnf}'...")
     cnf = CNF(from_file=path_cnf)
     print(f"CNF clauses: {len(cnf.clauses)}")
@@ -41,7 +104,7 @@ def cli(
 
     print()
     print(f"Loading backdoors from '{path_backdoors}'...")
-    backdoors = parse_backdoors(path_backdoors)
+    backdoors = parse_backdoors(path_backdoors, one_based=True)
     print(f"Total backdoors: {len(backdoors)}")
     if backdoors:
         print(f"First backdoor size: {len(backdoors[0])}")
@@ -51,74 +114,99 @@ def cli(
         print(f"Limiting to {limit_backdoors} backdoors")
         backdoors = backdoors[:limit_backdoors]
 
-    unique_variables = sorted(multiunion(backdoors), key=abs)
-    print(f"Total variables in {len(backdoors)} backdoors: {sum(map(len, backdoors))}")
+    # Note: only the number of unique variables is reported, so there is no need to sort them
+    unique_variables = multiunion(backdoors)
+    num_total_variables = sum(map(len, backdoors))
+    print(f"Total variables in {len(backdoors)} backdoors: {num_total_variables}")
     print(f"Unique variables in {len(backdoors)} backdoors: {len(unique_variables)}")
 
     print()
     is_using_solve_limited = num_confl > 0
     if is_using_solve_limited:
         print(f"Note: using 'propagate' and 'solve_limited({num_confl=})'")
-        solver_limited = Solver("cadical153", bootstrap_with=cnf)
     else:
         print(f"Note: using 'propagate' only")
+    if jobs > 1 and is_add_derived_units:
+        print(f"Note: adding derived units requires sequential processing, ignoring '--jobs {jobs}'")
+        jobs = 1
+
+    cache = None
+    if cache_dir:
+        cache = DiskCache(cache_dir, file_fingerprint(path_cnf))
+        print(f"Note: caching results in '{cache.root}'")
 
     rho_per_backdoor = []
     unique_derived_units = set()
+    unique_derived_units_neg = set()  # negations of 'unique_derived_units', for detecting conflicting units
     units_per_backdoor = []
     new_units_per_backdoor = []
 
-    with Solver("glucose42", bootstrap_with=cnf) as solver:
-        for i, variables in enumerate(backdoors):
-            print()
-            print(f"=== [{i+1}/{len(backdoors)}] " + "-" * 42)
-
-            # Convert to 1-based:
-            variables = [v + 1 for v in variables]
-
-            print(f"Backdoor with {len(variables)} variables: {variables}")
-
-            print(f"Partioning tasks...")
-            hard, easy = partition_tasks(solver, variables)
-            assert len(hard) + len(easy) == 2 ** len(variables)
-            print(f"Total 2^{len(variables)} = {2**len(variables)} tasks: {len(hard)} hard and {len(easy)} easy")
+    with contextlib.ExitStack() as stack:
+        pool = None
+        if jobs > 1:
+            print(f"Note: processing backdoors using {jobs} worker processes")
+            pool = stack.enter_context(
+                multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(path_cnf, num_confl, cache)),
+            )
+            results = pool.imap(_work, backdoors, chunksize=4)
+        else:
+            solver = stack.enter_context(Solver("glucose42", bootstrap_with=cnf))
+            solver_limited = None
+            if is_using_solve_limited:
+                solver_limited = stack.enter_context(Solver("cadical153", bootstrap_with=cnf))
 
-            rho = len(easy) / 2 ** len(variables)
-            print(f"rho = {len(easy)}/{2**len(variables)} = {rho}")
+        for i, variables in enumerate(backdoors):
+            log()
+            log(f"=== [{i+1}/{len(backdoors)}] " + "-" * 42)
+            k = len(variables)
+            num_tasks = 1 << k
+            log(f"Backdoor with {k} variables: {variables}")
+
+            if pool is not None:
+                result = next(results)
+            else:
+                # Note: derived units added to the solver change its state
+                state = derived_units_state(unique_derived_units, is_add_derived_units)
+                result = process_backdoor(solver, solver_limited, variables, num_confl, cache, state)
+            hard = result["hard"]
+            easy = result["easy"]
+            units = result["units"]
+
+            num_hard = popcount(hard)
+            num_easy = popcount(easy)
+            assert num_hard + num_easy == num_tasks
+            log(f"Total 2^{k} = {num_tasks} tasks: {num_hard} hard and {num_easy} easy")
+
+            rho = num_easy / num_tasks
+            log(f"rho = {num_easy}/{num_tasks} = {rho}")
             rho_per_backdoor.append(rho)
 
-            print()
+            log()
             if is_using_solve_limited:
-                print(f"Performing failed literal probing using 'solve_limited({num_confl=})'...")
-                time_start_limited = time.time()
-                units = perform_probing_limited(solver_limited, variables)
-                print(f"... done in {time.time() - time_start_limited:.3f} s")
+                log(f"Performed failed literal probing using 'solve_limited({num_confl=})' in {result['time_limited']:.3f} s")
             else:
-                print(f"Performing failed literal probing using 'propagate'...")
-                units = perform_probing(solver, variables)
-            print(f"Derived {len(units)} units: {units}")
-            for unit in units:
-                if -unit in unique_derived_units:
-                    raise RuntimeError("Wow!")
-            new_units = [x for x in units if x not in unique_derived_units]
-            print(f"{len(new_units)} new units: {new_units}")
+                log(f"Performed failed literal probing using 'propagate'")
+            if not is_quiet:
+                log(f"Derived {len(units)} units: {units}")
+            check_conflicting_units(units, unique_derived_units_neg)
+            new_units = sorted(set(units) - unique_derived_units, key=abs)
+            if not is_quiet:
+                log(f"{len(new_units)} new units: {new_units}")
             unique_derived_units.update(units)
+            unique_derived_units_neg.update(-x for x in units)
             units_per_backdoor.append(units)
             new_units_per_backdoor.append(new_units)
 
             if is_add_derived_units:
-                for unit in new_units:
-                    solver.add_clause([unit])
+                add_units(solver, solver_limited, new_units)
 
-    if is_using_solve_limited:
-        solver_limited.delete()
-        del solver_limited
+            sys.stdout.flush()
 
     print()
     print("=" * 42)
     print()
 
-    print(f"Total variables in {len(backdoors)} backdoors: {sum(map(len, backdoors))}")
+    print(f"Total variables in {len(backdoors)} backdoors: {num_total_variables}")
     print(f"Unique variables in {len(backdoors)} backdoors: {len(unique_variables)}")
 
     unique_derived_units = sorted(unique_derived_units, key=abs)